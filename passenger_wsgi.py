@@ -11,6 +11,8 @@ import repeating_ical_events_http
 uid_gens = repeating_ical_events_http.HostUidGen()
 application = flask.Flask(repeating_ical_events_http.__name__)
 repeating_ical_events_http.SetupLogging('log', application, logging.INFO)
+# Structured per-request records. See repeating_events_stats.
+access_log = repeating_ical_events_http.AccessLog('access_log')
 
 # Cache hashes of static content (which must be in './static/' directory).
 static_versions = repeating_ical_events_http.StaticVersions(application)
@@ -21,5 +23,5 @@ static_versions = repeating_ical_events_http.StaticVersions(application)
 @application.route('/', methods=['GET', 'POST'])
 def RepeatingEvents():
   req_handler = repeating_ical_events_http.RequestHandler(
-    uid_gens, static_versions, application, flask.request)
+    uid_gens, static_versions, application, flask.request, access_log)
   return req_handler.Response()
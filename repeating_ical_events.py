@@ -2,8 +2,11 @@
 events. See main() for a usage example."""
 
 import datetime
+import heapq
 import icalendar
+import itertools
 import random
+import re
 import sys
 import string
 import threading
@@ -76,7 +79,8 @@ class CalendarBuilder(icalendar.Calendar):
 
   def AddEvent(self):
     """Return an EventBuilder for a vevent to be added."""
-    ev = EventBuilder(self._uid_gen.GetUid(), datetime.datetime.utcnow())
+    ev = EventBuilder(self._uid_gen.GetUid(),
+                      datetime.datetime.now(datetime.timezone.utc))
     self.add_component(ev)
     return ev
 
@@ -89,6 +93,9 @@ class ScheduleBuilder(object):
     self.end_time = end_time
     # List of (summary, datetime.timedelta).
     self._repeating_events = []
+    # Number of vevents created by the last BuildCalendar(), BuildIcal() or
+    # completed IterIcal().
+    self.num_occurrences = None
     self.SetDefaults()
 
   def SetDefaults(self):
@@ -111,49 +118,218 @@ class ScheduleBuilder(object):
 
   def NumEvents(self): return len(self._repeating_events)
 
+  def OccurrenceCost(self):
+    """Relative cost of generating one vevent with the configured alarms."""
+    cost = 1
+    if self.set_alarms:
+      cost += 1
+      if self.alarms_repeat:
+        cost += 1
+    return cost
+
+  def Cost(self):
+    """Return an upper bound of the cost of building the calendar: each
+    repeating event costs one plus its repetitions times OccurrenceCost() and
+    the cost of its summary. A merged SUMMARY is at most the summaries of its
+    repeating events, so merging overlapping events only lowers the actual
+    cost."""
+    occurrence_cost = self.OccurrenceCost()
+    return sum(
+      1 + NumRepetitions(self.start_time, self.end_time, period) *
+      (occurrence_cost + _SummaryCost(summary))
+      for summary, period in self._repeating_events)
+
+  def _Occurrences(self):
+    """Yield (event_time, indices) for each vevent in time order. indices lists
+    the index in _repeating_events of each repeating event merged into the
+    vevent; the first is used for the alarm description. Memory use is
+    proportional to the number of repeating events, not the number of
+    occurrences."""
+    def Times(index, period):
+      event_time = self.start_time
+      while event_time <= self.end_time:
+        yield event_time, index
+        # Compare before adding: event_time + period may overflow datetime.
+        if self.end_time - event_time < period:
+          break
+        event_time += period
+    # The index orders events at the same time as they were added.
+    times = heapq.merge(*[
+      Times(index, period)
+      for index, (_, period) in enumerate(self._repeating_events)
+      if period > datetime.timedelta(0)])
+    if not self.merge_overlap:
+      for event_time, index in times:
+        yield event_time, [index]
+      return
+    for event_time, group in itertools.groupby(times, key=lambda x: x[0]):
+      yield event_time, [index for _, index in group]
+
+  def _Summary(self, indices):
+    """Return the summary of a vevent merged from the repeating events at
+    indices."""
+    return ' '.join(self._repeating_events[index][0] for index in indices
+                    if self._repeating_events[index][0])
+
   def BuildCalendar(self, uid_gen):
     """Return a icalendar.Calendar object for the schedule. RRULEs of
     hourly granularity or smaller are not supported in the UI of most
     calendar programs, so create separate entries rather than an
     RRULE."""
-    # Map datetime to list of EventBuilder.
-    events = {}
     cal = CalendarBuilder(uid_gen)
-    for summary, period in self._repeating_events:
-      if period <= datetime.timedelta(0):
-        continue
-      next_event_time = self.start_time
-      while next_event_time <= self.end_time:
-        next_event_time_events = events.setdefault(next_event_time, [])
-        if self.merge_overlap and next_event_time_events:
-          ev_summary = next_event_time_events[0].get('summary')
-          if ev_summary:
-            ev_summary = ev_summary + ' ' + summary
-          else:
-            ev_summary = summary
-          next_event_time_events[0]['summary'] = ev_summary
-        else:
-          next_event_time_events.append(self._AddEvent(
-            cal, summary, next_event_time))
-        next_event_time += period
+    self.num_occurrences = 0
+    for event_time, indices in self._Occurrences():
+      ev = self._AddEvent(
+        cal, self._repeating_events[indices[0]][0], event_time)
+      if len(indices) > 1:
+        ev['summary'] = self._Summary(indices)
+      self.num_occurrences += 1
     return cal
 
+  def BuildIcal(self, uid_gen):
+    """Return data equivalent to BuildCalendar(uid_gen).to_ical(), serialized
+    directly. The vevents have the same properties, but in a different order,
+    and share one DTSTAMP. See IterIcal()."""
+    return b''.join(self.IterIcal(uid_gen))
+
+  def IterIcal(self, uid_gen, chunk_size=2**16):
+    """Yield BuildIcal() data in chunks of about chunk_size bytes. Memory use
+    does not grow with the number of occurrences. The lines that are identical
+    for every occurrence of a repeating event (duration, transp and the alarm)
+    are serialized once per repeating event and reused, so the per-occurrence
+    work is DTSTART, UID and, for merged events, SUMMARY. num_occurrences is
+    set when the last chunk is yielded."""
+    header, end, trailer = CalendarBuilder(uid_gen).to_ical().rpartition(
+      b'END:VCALENDAR')
+    # Serializes single content lines.
+    line_ev = icalendar.Event()
+    # Like EventBuilder, but the time is shared by all vevents.
+    dtstamp = line_ev.content_line('DTSTAMP', icalendar.vDatetime(
+      datetime.datetime.now(datetime.timezone.utc))).to_ical()
+    # Map index in _repeating_events to its serialized SUMMARY and constant
+    # lines. Their total size is bounded by the repeating events, not by the
+    # occurrences or combinations of merged events. Merged SUMMARY lines are
+    # not cached.
+    summary_lines = {}
+    blocks = {}
+    num_occurrences = 0
+    chunks = [header]
+    size = len(header)
+    for event_time, indices in self._Occurrences():
+      index = indices[0]
+      block = blocks.get(index)
+      if block is None:
+        summary = self._repeating_events[index][0]
+        summary_lines[index] = _TextLine(line_ev, 'SUMMARY', summary)
+        block = self._EventBlock(summary)
+        blocks[index] = block
+      if len(indices) == 1:
+        summary_line = summary_lines[index]
+      else:
+        summary_line = _TextLine(line_ev, 'SUMMARY', self._Summary(indices))
+      chunk = b'\r\n'.join((
+        b'BEGIN:VEVENT',
+        _DtstartLine(line_ev, event_time),
+        dtstamp,
+        _TextLine(line_ev, 'UID', uid_gen.GetUid()),
+        summary_line,
+        block))
+      chunks.append(chunk)
+      size += len(chunk)
+      num_occurrences += 1
+      if size >= chunk_size:
+        yield b''.join(chunks)
+        chunks = []
+        size = 0
+    chunks.append(end + trailer)
+    self.num_occurrences = num_occurrences
+    yield b''.join(chunks)
+
+  def _EventBlock(self, summary):
+    """Return the serialized constant lines, other than SUMMARY, of a vevent
+    for the repeating event summary, through END:VEVENT."""
+    ev = icalendar.Event()
+    self._AddEventProperties(ev, summary)
+    return ev.to_ical().split(b'\r\n', 1)[1]
+
   def _AddEvent(self, cal, summary, event_time):
     ev = cal.AddEvent()
     ev.add('dtstart', event_time)
+    ev.add('summary', summary)
+    self._AddEventProperties(ev, summary)
+    return ev
+
+  def _AddEventProperties(self, ev, alarm_description):
+    """Add the properties and alarm that are the same for every occurrence of
+    a repeating event."""
     ev.add('duration', self.event_duration)
     if self.show_busy:
       transp = 'OPAQUE'
     else:
       transp = 'TRANSPARENT'
     ev.add('transp', transp)
-    ev.add('summary', summary)
     if self.set_alarms:
-      al = ev.AddDisplayAlarm(summary, -self.alarm_before)
+      al = DisplayAlarmBuilder(alarm_description, -self.alarm_before)
       if self.alarms_repeat:
         al.add('duration', self.alarm_repetition_delay)
         al.add('repeat', self.alarm_repetitions)
-    return ev
+      ev.add_component(al)
+
+
+# Bytes of summary text generated per unit of ScheduleBuilder.Cost().
+_summary_bytes_per_cost = 64
+
+# Characters that vText escapes.
+_text_escaped = re.compile(r'[\\;,\r\n]')
+
+
+def NumRepetitions(start_time, end_time, period):
+  """Return the number of times an event repeating every period occurs in the
+  inclusive range [start_time, end_time]."""
+  if period <= datetime.timedelta(0) or end_time < start_time:
+    return 0
+  # start_time and end_time are an inclusive range, so if end_time==start_time
+  # [or any span < period], there is one event.
+  return (end_time - start_time) // period + 1
+
+
+def _SummaryCost(summary):
+  """Return the cost of a summary in each vevent, including the separator
+  when merged."""
+  return -(-(len(summary) + 1) // _summary_bytes_per_cost)
+
+
+def _DtstartLine(line_ev, event_time):
+  """Serialize DTSTART without the general icalendar code path for the usual
+  case of a floating (naive) local time."""
+  if event_time.tzinfo is None:
+    return ('DTSTART:%04d%02d%02dT%02d%02d%02d' % (
+      event_time.year, event_time.month, event_time.day, event_time.hour,
+      event_time.minute, event_time.second)).encode()
+  return line_ev.content_line(
+    'DTSTART', icalendar.vDatetime(event_time)).to_ical()
+
+
+def _TextLine(line_ev, name, text):
+  """Serialize a text property without the general icalendar code path, which
+  folds long lines one character at a time, unless text is not ASCII."""
+  line = ('%s:%s' % (name, text)).encode()
+  if len(line) < 75 and not _text_escaped.search(text):
+    return line
+  if not text.isascii():
+    return line_ev.content_line(name, icalendar.vText(text)).to_ical()
+  line = name.encode() + b':' + icalendar.vText(text).to_ical()
+  # Fold into lines of 74 octets like icalendar, without splitting an escape.
+  folded = []
+  start = 0
+  while len(line) - start > 74:
+    end = start + 74
+    if line[end - 1:end] == b'\\':
+      end -= 1
+    folded.append(line[start:end])
+    start = end
+  folded.append(line[start:])
+  return b'\r\n '.join(folded)
 
 
 def main(argv):
@@ -167,11 +343,11 @@ def main(argv):
   scheduler.alarms_repeat = False
   scheduler.AddRepeatingEvent('Event Type 1', datetime.timedelta(hours=6))
   scheduler.AddRepeatingEvent('Event Type 2', datetime.timedelta(hours=2))
-  cal = scheduler.BuildCalendar(UidGenerator('example.com'))
+  ical = scheduler.BuildIcal(UidGenerator('example.com'))
 
   # Must be written as binary, not Unicode, as sys.stdout requires.
   with open('/dev/stdout', 'wb') as outf:
-    outf.write(cal.to_ical())
+    outf.write(ical)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,153 @@
+"""Benchmark repeating_ical_events.ScheduleBuilder.IterIcal().
+
+First, generates per-minute reminders with up to max_occurrences and reports
+the peak memory allocated while generating, which should stay flat as the
+number of occurrences grows. Then, generates worst case schedules, e.g.
+1000 overlapping events, scaled to repeating_ical_events_http.ScheduleForm's
+default cost limit. These must finish well within RequestHandler's time limit,
+so that the time limit is only a last resort. Exits with an error if any
+schedule exceeds the time or memory limits.
+
+Usage: python repeating_ical_events_bench.py [max_occurrences]
+"""
+
+import datetime
+import repeating_ical_events
+import repeating_ical_events_http
+import sys
+import time
+import tracemalloc
+
+# Peak memory allowed while generating any schedule.
+_max_peak_bytes = 2**22
+
+# Fraction of RequestHandler.max_generation_secs that a schedule at the cost
+# limit may take.
+_max_generation_fraction = 0.25
+
+_start_time = datetime.datetime(year=2019, month=4, day=25, hour=7)
+_minute = datetime.timedelta(minutes=1)
+
+
+def _LongSummary(i):
+  return ('Event %d ' % i).ljust(repeating_ical_events_http._summary_max, 'x')
+
+
+def MinuteSchedule(minutes):
+  """A per-minute event with a short summary and no alarms: the most
+  per-occurrence overhead for its cost."""
+  sched = repeating_ical_events.ScheduleBuilder(
+    _start_time, _start_time + minutes * _minute)
+  sched.AddRepeatingEvent('Minute', _minute)
+  return sched
+
+
+def AlarmSchedule(minutes):
+  """Per-minute reminders with alarms, plus an hourly event that overlaps
+  them."""
+  sched = MinuteSchedule(minutes)
+  sched.set_alarms = True
+  sched.AddRepeatingEvent('Hour', datetime.timedelta(hours=1))
+  return sched
+
+
+def OverlapSchedule(minutes):
+  """The maximum number of events, with periods of 1 to 1000 minutes, long
+  summaries and alarms. Almost every occurrence merges a different
+  combination of events."""
+  sched = repeating_ical_events.ScheduleBuilder(
+    _start_time, _start_time + minutes * _minute)
+  sched.set_alarms = True
+  for i in range(1000):
+    sched.AddRepeatingEvent(_LongSummary(i), (i + 1) * _minute)
+  return sched
+
+
+def SameTimeSchedule(minutes):
+  """500 per-minute events and 500 with periods of 2 to 501 minutes, with long
+  summaries. Every occurrence merges at least 500 events."""
+  sched = repeating_ical_events.ScheduleBuilder(
+    _start_time, _start_time + minutes * _minute)
+  for i in range(500):
+    sched.AddRepeatingEvent(_LongSummary(i), _minute)
+  for i in range(500):
+    sched.AddRepeatingEvent(_LongSummary(500 + i), (i + 2) * _minute)
+  return sched
+
+
+def NoMergeSchedule(minutes):
+  """The maximum number of events, with periods of 1 to 1000 minutes, short
+  summaries and no merging."""
+  sched = repeating_ical_events.ScheduleBuilder(
+    _start_time, _start_time + minutes * _minute)
+  sched.merge_overlap = False
+  for i in range(1000):
+    sched.AddRepeatingEvent('Event %d' % i, (i + 1) * _minute)
+  return sched
+
+
+def ScaleToCost(make_schedule, max_cost):
+  """Return make_schedule(minutes) with the most minutes within max_cost."""
+  minutes = 1000
+  cost = make_schedule(minutes).Cost()
+  # Cost is about linear in minutes. Shrink until it fits.
+  minutes = int(minutes * max_cost / cost)
+  while make_schedule(minutes).Cost() > max_cost:
+    minutes = int(minutes * 0.99)
+  return make_schedule(minutes)
+
+
+def Generate(sched, uid_gen):
+  """Consume IterIcal() and return the number of bytes generated."""
+  num_bytes = 0
+  for chunk in sched.IterIcal(uid_gen):
+    num_bytes += len(chunk)
+  return num_bytes
+
+
+def Run(name, make_schedule, uid_gen, max_secs_per_cost):
+  """Benchmark the schedule from make_schedule(). Return True if it is within
+  max_secs_per_cost times its cost and _max_peak_bytes."""
+  sched = make_schedule()
+  max_secs = max_secs_per_cost * sched.Cost()
+  start = time.perf_counter()
+  num_bytes = Generate(sched, uid_gen)
+  secs = time.perf_counter() - start
+  # Memory is measured in a separate run: tracing slows generation.
+  tracemalloc.start()
+  Generate(make_schedule(), uid_gen)
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  print('%s: occurrences=%d cost=%d bytes=%d secs=%.2f us/cost=%.2f '
+        'peak_mem=%d' % (
+          name, sched.num_occurrences, sched.Cost(), num_bytes, secs,
+          secs / sched.Cost() * 1e6, peak))
+  if secs > max_secs or peak > _max_peak_bytes:
+    print('FAIL: limits are %.2f secs, %d bytes' % (max_secs, _max_peak_bytes))
+    return False
+  return True
+
+
+def main(argv):
+  max_occurrences = int(argv[1]) if len(argv) > 1 else 10**6
+  uid_gen = repeating_ical_events.UidGenerator('example.com')
+  max_cost = repeating_ical_events_http.ScheduleForm.max_cost
+  max_secs_per_cost = (
+    repeating_ical_events_http.RequestHandler.max_generation_secs *
+    _max_generation_fraction / max_cost)
+  ok = True
+  num_occurrences = 1000
+  while num_occurrences <= max_occurrences:
+    ok &= Run('AlarmSchedule', lambda: AlarmSchedule(num_occurrences - 1),
+              uid_gen, max_secs_per_cost)
+    num_occurrences *= 10
+  for make_schedule in (MinuteSchedule, AlarmSchedule, OverlapSchedule,
+                        SameTimeSchedule, NoMergeSchedule):
+    ok &= Run('%s at max_cost' % make_schedule.__name__,
+              lambda: ScaleToCost(make_schedule, max_cost), uid_gen,
+              max_secs_per_cost)
+  return 0 if ok else 1
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
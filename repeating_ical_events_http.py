@@ -3,12 +3,14 @@
 import datetime
 import flask
 import hashlib
+import json
 import logging
 import logging.handlers
 import os
 import re
 import repeating_ical_events
 import threading
+import time
 import traceback
 import wtforms
 
@@ -41,7 +43,8 @@ class HostUidGen(object):
       return uid_gen
 
 
-def SetupLogging(dirname, app, level):
+def _RemoveOldLogs(dirname):
+  """Create dirname if needed and remove the oldest files in it."""
   dir_perms = 0o700
   os.makedirs(dirname, mode=dir_perms, exist_ok=True)
   os.chmod(dirname, dir_perms)
@@ -62,24 +65,69 @@ def SetupLogging(dirname, app, level):
         os.unlink(path)
       except FileNotFoundError:
         pass  # Some other instance of this deleted it already?
+
+
+def _RotatingFileHandler(dirname, ext):
+  """Return a per-PID RotatingFileHandler for a file in dirname."""
   stemname = '%s.%d' % (__name__, os.getpid())
-  path = os.path.join(dirname, '%s.log' % stemname)
+  path = os.path.join(dirname, '%s.%s' % (stemname, ext))
   handler = logging.handlers.RotatingFileHandler(
     path, maxBytes=2**20, backupCount=9, delay=True)
   handler.set_name(stemname)
-  # Same as flask format.
-  handler.setFormatter(logging.Formatter(
-    '[%(asctime)s] %(levelname)s in %(module)s: %(message)s'))
   # Replace open method with a method that sets permissions. This is the same
   # as the FileHandler._open method, but with a custom opener to set the
   # permissions on new files.
   handler._open = lambda: open(
     handler.baseFilename, handler.mode, encoding=handler.encoding,
     opener=lambda path, flags: os.open(path, flags, mode=0o600))
+  return handler
+
+
+def SetupLogging(dirname, app, level):
+  _RemoveOldLogs(dirname)
+  handler = _RotatingFileHandler(dirname, 'log')
+  # Same as flask format.
+  handler.setFormatter(logging.Formatter(
+    '[%(asctime)s] %(levelname)s in %(module)s: %(message)s'))
   app.logger.handlers.append(handler)
   app.logger.setLevel(level)
 
 
+class AccessLog(object):
+  """Structured access log. Each request is one JSON object per line (JSON
+  Lines) with a fixed schema, appended to a rotating per-PID file. See
+  repeating_events_stats for aggregation. Thread-safe."""
+
+  # Record fields, in the order written.
+  FIELDS = ('ts', 'remote', 'method', 'path', 'status', 'latency_us',
+            'occurrences', 'bytes')
+
+  def __init__(self, dirname):
+    _RemoveOldLogs(dirname)
+    handler = _RotatingFileHandler(dirname, 'jsonl')
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    self._logger = logging.getLogger('%s.access' % __name__)
+    # The logger is process-global. Replace the handler of any previous
+    # AccessLog rather than duplicating records.
+    for old in [h for h in self._logger.handlers
+                if h.get_name() == handler.get_name()]:
+      self._logger.removeHandler(old)
+      old.close()
+    self._logger.addHandler(handler)
+    self._logger.setLevel(logging.INFO)
+    # Keep access records out of the application log.
+    self._logger.propagate = False
+
+  def Log(self, remote, method, path, status, latency_us, occurrences,
+          num_bytes):
+    """Append a record. occurrences and num_bytes may be None if unknown.
+    latency_us includes the time to send a streamed response."""
+    values = (round(time.time(), 3), remote, method, path, status, latency_us,
+              occurrences, num_bytes)
+    self._logger.info('%s', json.dumps(dict(zip(AccessLog.FIELDS, values)),
+                                       separators=(',', ':')))
+
+
 class StaticVersions(object):
   """Generate URLs for static content. The contents of files are hashed and this
   hash is included in a version query parameter so browsers will reload
@@ -306,10 +354,18 @@ class ScheduleForm(wtforms.Form):
   alarm_repetition_delay_secs = SecondsField(
     'If alarms repeat, number of seconds between each repetition',
     [validators.InputRequired()], default=_d.alarm_repetition_delay)
-  events = FieldList(FormField(EventForm), label='',
-                       min_entries=1, max_entries=100)
+  # WTForms builds an EventForm for each submitted index before validate(), so
+  # the cost budget cannot bound parsing. Each takes ~75 us.
+  events = FieldList(FormField(EventForm), label='', min_entries=1,
+                     max_entries=1000)
   had_errors = HiddenField()
 
+  # Limit of repeating_ical_events.ScheduleBuilder.Cost(). Servers may set
+  # app.config['MAX_SCHEDULE_COST'] instead; see RequestHandler. The worst
+  # schedules in repeating_ical_events_bench.py take ~3 us and generate ~90
+  # bytes per unit of cost, so the default limit is ~1.5 s and ~45 MB.
+  max_cost = 500000
+
   def validate(self):
     """Override validate() to only validate fields that are used according to
       user specified configuration. Perform additional validation that applies
@@ -325,34 +381,12 @@ class ScheduleForm(wtforms.Form):
     total_period = None
     if self.start_time.data is not None and self.end_time.data is not None:
       total_period = self.end_time.data - self.start_time.data
-      if (total_period < datetime.timedelta(seconds=0) or
-          total_period > datetime.timedelta(days=100)):
+      if total_period < datetime.timedelta(seconds=0):
         form_valid = False
         self.start_time.data = None
         self.end_time.data = None
         self.end_time.errors.append(
           'Invalid period between start and end times: %s' % total_period)
-      else:
-        # Valid total_period. Validate numbers of event repetitions.
-        for event in self.events:
-          if event.period.data is None:
-            continue
-          if event.period.data <= datetime.timedelta(0):
-            num_reps = 0
-          else:
-            # start_time and end_time are an inclusive range, so if
-            # total_period==0 [or any value < event.period.data], there is one
-            # event.
-            num_reps = int(total_period / event.period.data) + 1
-          if num_reps > 1000:
-            form_valid = False
-            event.period.data = None
-            if event.summary.data:
-              summary = event.summary.data
-            else:
-              summary = 'event'
-            event.period.errors.append(
-              'Invalid number of repetitions for %s: %d' % (summary, num_reps))
     if self.set_alarms.data:
       # If alarms are enabled, validate additional required fields.
       for field in (self.alarm_before_secs, self.alarms_repeat):
@@ -376,6 +410,22 @@ class ScheduleForm(wtforms.Form):
             self.alarm_repetitions.data = None
             self.alarm_repetition_delay_secs.errors.append(
               'Invalid alarm repetition duration %s' % rep_period)
+    if form_valid:
+      # Limit the total work to generate the calendar, rather than the number
+      # of events or repetitions of each.
+      sched = repeating_ical_events.ScheduleBuilder(
+        self.start_time.data, self.end_time.data)
+      sched.set_alarms = self.set_alarms.data
+      sched.alarms_repeat = self.alarms_repeat.data
+      for event in self.events:
+        sched.AddRepeatingEvent(event.summary.data, event.period.data)
+      cost = sched.Cost()
+      if cost > self.max_cost:
+        form_valid = False
+        self.end_time.errors.append(
+          'Schedule too large (cost %d, limit %d). Use fewer events, longer '
+          'event periods or less time between start and end' % (
+            cost, self.max_cost))
     return form_valid
 
   def IsHidden(self, field):
@@ -398,15 +448,33 @@ del _d  # Defaults needed only for class ScheduleForm definition.
 
 
 class RequestHandler(object):
-  def __init__(self, uid_gens, static_versions, app, req):
-    """Give HostUidGen instance and flask.request."""
+  # Limit of seconds spent generating a calendar, excluding time spent sending
+  # it. Servers may set app.config['MAX_SCHEDULE_SECS'] instead. Only a last
+  # resort: schedules within ScheduleForm.max_cost take a quarter of this at
+  # most (see repeating_ical_events_bench.py). The status and headers are sent
+  # by then, so a timeout drops the connection rather than sending an error
+  # response. Clients without chunked encoding, e.g. HTTP/1.0 or behind a
+  # buffering proxy, may not notice that the calendar is truncated.
+  max_generation_secs = 10.0
+
+  def __init__(self, uid_gens, static_versions, app, req, access_log=None):
+    """Give HostUidGen instance and flask.request. access_log is an optional
+    AccessLog."""
     self._uid_gens = uid_gens
     self._static_versions = static_versions
     self._app = app
     self._req = req
+    self._access_log = access_log
+    # ScheduleBuilder of the calendar response, if any.
+    self._sched = None
+    # Bytes of the streamed calendar response sent so far.
+    self._bytes_sent = 0
+    # True if generating the streamed calendar response failed.
+    self._stream_failed = False
 
   def Response(self):
     """Return the response to the request given in __init__."""
+    start = time.monotonic()
     try:
       if self._req.method == 'POST':
         rv = self._ValidateForm()
@@ -424,8 +492,25 @@ class RequestHandler(object):
       self._app.logger.info(
         'method=%s path=%s remote=%s result=%s',
         self._req.method, self._req.path, self._req.remote_addr, rv.status_code)
+      if self._access_log:
+        # Calendars are streamed, so log once the response is sent.
+        # flask.request is not available after the response, so copy it.
+        req = (self._req.remote_addr, self._req.method, self._req.path)
+        rv.call_on_close(lambda: self._LogAccess(rv, req, start))
       return rv
 
+  def _LogAccess(self, rv, req, start):
+    """Log rv to the access log. req is (remote, method, path)."""
+    occurrences = None
+    num_bytes = rv.content_length
+    if self._sched:
+      occurrences = self._sched.num_occurrences
+      num_bytes = self._bytes_sent
+    status = 500 if self._stream_failed else rv.status_code
+    self._access_log.Log(
+      *req, status, int((time.monotonic() - start) * 1e6),
+      occurrences, num_bytes)
+
   def _IndexParams(self, form, autosubmit):
     return {
       'resources': self._static_versions,
@@ -479,6 +564,7 @@ class RequestHandler(object):
     from JS onload. Finally, if valid, and no errors were displayed previously,
     just respond with form data (fewest request-response round trips)."""
     form = ScheduleForm(self._req.form)
+    form.max_cost = self._app.config.get('MAX_SCHEDULE_COST', form.max_cost)
     if not form.validate():
       return self._BadRequestForm(form)
     if form.had_errors.data:
@@ -488,7 +574,13 @@ class RequestHandler(object):
     self._SetConfig(sched, form)
     for event in form.events:
       sched.AddRepeatingEvent(event.summary.data, event.period.data)
-    cal = sched.BuildCalendar(self._uid_gens.UidGen(self._req))
+    chunks = sched.IterIcal(self._uid_gens.UidGen(self._req))
+    # Generate the first chunk here, so Response() handles errors in it.
+    start = time.monotonic()
+    first_chunk = next(chunks)
+    generation_secs = time.monotonic() - start
+    # Only now is the response a streamed calendar; see _LogAccess().
+    self._sched = sched
     # TODO: Directly responding to form post with this text/calendar attachment
     # triggers a browser debug console warning "Resource interpreted as
     # Document". Setting target="_blank" would fix this in chrome, but we only
@@ -498,8 +590,35 @@ class RequestHandler(object):
     # is now, the no-errors case is the optimal case in terms of round-trips.
     # The extra round trip to clean up the errors displayed is a nice UI
     # improvement. In firefox, _blank triggers popup blocking.
-    resp = flask.Response(cal.to_ical(), mimetype='text/calendar')
+    resp = flask.Response(self._StreamChunks(first_chunk, chunks,
+                                             generation_secs),
+                          mimetype='text/calendar')
     resp.headers.add('Content-Disposition', 'attachment',
         filename='repeating_events_%s.ics' % sched.start_time.strftime(
           '%Y_%m_%d'))
     return resp
+
+  def _StreamChunks(self, first_chunk, chunks, generation_secs):
+    """Yield first_chunk and then chunks, counting their bytes for the access
+    log. generation_secs is the time spent generating first_chunk. The rest of
+    the calendar is generated after Response() has returned, so enforce the
+    time limit and log errors here. Re-raise errors so the server aborts the
+    response rather than sending a truncated calendar."""
+    max_secs = self._app.config.get('MAX_SCHEDULE_SECS',
+                                    self.max_generation_secs)
+    try:
+      chunk = first_chunk
+      while chunk is not None:
+        self._bytes_sent += len(chunk)
+        yield chunk
+        start = time.monotonic()
+        chunk = next(chunks, None)
+        generation_secs += time.monotonic() - start
+        if chunk is not None and generation_secs > max_secs:
+          raise TimeoutError(
+            'Calendar generation exceeded %s secs' % max_secs)
+    except Exception:
+      self._stream_failed = True
+      self._app.logger.error('Unexpected exception while streaming %s',
+                             traceback.format_exc())
+      raise